@@ -11,11 +11,14 @@ Telegram-бот техподдержки Орион.
   python bot.py
 """
 
+import asyncio
 import logging
 import time
+from functools import lru_cache
 
 from telegram import Update
 from telegram.ext import (
+    AIORateLimiter,
     ApplicationBuilder,
     CommandHandler,
     MessageHandler,
@@ -26,12 +29,14 @@ from telegram.ext import (
 from search_solution import (
     load_config,
     get_sheet_url,
+    get_refresh_interval,
     get_object_synonyms,
+    prepare_object_synonyms,
     load_rows_with_fallback,
     detect_object_code,
     find_best_with_object,
     fetch_rows,
-    _get_field_case_insensitive,
+    prepare_rows,
 )
 
 # ─── Config ──────────────────────────────────────────────────────────────────
@@ -50,19 +55,31 @@ MIN_SCORE = 0.35
 # ─── Global state ────────────────────────────────────────────────────────────
 
 sheet_url = get_sheet_url(config)
-object_synonyms = get_object_synonyms(config)
-rows: list[dict] = []
-upload_mode: dict[int, float] = {}  # user_id -> expiry timestamp
+refresh_interval = get_refresh_interval(config)
+object_synonyms = prepare_object_synonyms(get_object_synonyms(config))
+upload_mode: dict[int, float] = {}  # user_id -> expiry (time.monotonic)
 
 UPLOAD_TIMEOUT = 300  # 5 минут
 
 
-def refresh_rows() -> None:
-    global rows
-    new = fetch_rows(sheet_url)
+# Неизменяемый PreparedRows; заменяется целиком одним присваиванием, поэтому
+# обработчик, взявший ссылку на снимок, всегда видит согласованные данные.
+_snapshot = prepare_rows([])
+
+
+async def refresh_rows() -> None:
+    """Скачать таблицу в отдельном потоке, не блокируя обработку апдейтов."""
+    global _snapshot
+    new = await asyncio.to_thread(fetch_rows, sheet_url)
     if new:
-        rows = new
-        logger.info("Данные обновлены из Google Sheets (%d строк).", len(rows))
+        _snapshot = new
+        logger.info("Данные обновлены из Google Sheets (%d строк).", len(new))
+
+
+@lru_cache(maxsize=4096)
+def _cached_detect(query: str) -> str | None:
+    """detect_object_code с мемоизацией: синонимы не меняются после старта."""
+    return detect_object_code(query, object_synonyms)
 
 
 # ─── Formatting ──────────────────────────────────────────────────────────────
@@ -85,10 +102,11 @@ def format_result(scored: list) -> tuple[str, list[str], list[str]]:
         )
 
     score, row = good[0]
-    problem = _get_field_case_insensitive(row, "Проблема")
-    solution = _get_field_case_insensitive(row, "Решение")
-    solution2 = _get_field_case_insensitive(row, "Решение_2")
-    obj = _get_field_case_insensitive(row, "Объект")
+    # load_rows() отдаёт строки с ключами в нижнем регистре
+    problem, solution, solution2, obj, video, photo = (
+        row.get(k) or ""
+        for k in ("проблема", "решение", "решение_2", "объект", "видео", "фото")
+    )
 
     header = "▸ Нашла!"
     if obj:
@@ -103,8 +121,8 @@ def format_result(scored: list) -> tuple[str, list[str], list[str]]:
     if solution2.strip():
         block.append(f"Решение 2: {solution2}")
 
-    video_ids = _parse_file_ids(_get_field_case_insensitive(row, "Видео"))
-    photo_ids = _parse_file_ids(_get_field_case_insensitive(row, "Фото"))
+    video_ids = _parse_file_ids(video)
+    photo_ids = _parse_file_ids(photo)
 
     return "\n".join(block), video_ids, photo_ids
 
@@ -139,7 +157,7 @@ async def cmd_help(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
 async def cmd_upload(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     uid = update.effective_user.id
-    upload_mode[uid] = time.time() + UPLOAD_TIMEOUT
+    upload_mode[uid] = time.monotonic() + UPLOAD_TIMEOUT
     await update.message.reply_text(
         "Режим загрузки включён на 5 минут.\n"
         "Отправь видео или фото — я верну file_id для таблицы."
@@ -151,7 +169,7 @@ async def handle_upload(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     expiry = upload_mode.get(uid, 0)
 
     # Upload mode активен — вернуть file_id
-    if time.time() <= expiry:
+    if time.monotonic() <= expiry:
         if update.message.video or update.message.document:
             media = update.message.video or update.message.document
             label = "Видео"
@@ -183,31 +201,33 @@ async def handle_upload(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
 
 
 async def _search_and_reply(update: Update, query: str) -> None:
-    if not rows:
+    snap = _snapshot
+    if not snap.rows:
         await update.message.reply_text(
             "База знаний пуста. Попробуй /reload или напиши инженеру."
         )
         return
     logger.info("Запрос от %s: %s", update.effective_user.first_name, query)
-    obj_code = detect_object_code(query, object_synonyms)
-    scored = find_best_with_object(query, rows, TOP_N, obj_code)
+    obj_code = _cached_detect(query.lower())
+    scored = find_best_with_object(query, snap, TOP_N, obj_code)
     answer, video_ids, photo_ids = format_result(scored)
     await update.message.reply_text(answer)
-    for pid in photo_ids:
-        try:
-            await update.message.reply_photo(pid)
-        except Exception:
-            logger.warning("Не удалось отправить фото: %s", pid)
-    for vid in video_ids:
-        try:
-            await update.message.reply_video(vid)
-        except Exception:
-            logger.warning("Не удалось отправить видео: %s", vid)
+
+    # Медиа отправляем параллельно; лимиты Telegram соблюдает AIORateLimiter
+    media = [("фото", pid) for pid in photo_ids] + [("видео", vid) for vid in video_ids]
+    results = await asyncio.gather(
+        *(update.message.reply_photo(pid) for pid in photo_ids),
+        *(update.message.reply_video(vid) for vid in video_ids),
+        return_exceptions=True,
+    )
+    for (label, fid), result in zip(media, results):
+        if isinstance(result, Exception):
+            logger.warning("Не удалось отправить %s: %s", label, fid)
 
 
 async def cmd_reload(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    refresh_rows()
-    await update.message.reply_text(f"База обновлена. Записей: {len(rows)}")
+    await refresh_rows()
+    await update.message.reply_text(f"База обновлена. Записей: {len(_snapshot.rows)}")
 
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -228,6 +248,10 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await _search_and_reply(update, query)
 
 
+async def job_refresh(context: ContextTypes.DEFAULT_TYPE) -> None:
+    await refresh_rows()
+
+
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Логируем ошибку и продолжаем работу."""
     logger.error("Ошибка при обработке запроса: %s", context.error)
@@ -238,12 +262,12 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
 
 def main() -> None:
     # Initial data load
-    global rows
-    rows = load_rows_with_fallback(sheet_url)
-    if not rows:
+    global _snapshot
+    _snapshot = load_rows_with_fallback(sheet_url)
+    if not _snapshot.rows:
         logger.warning("Не удалось загрузить данные при старте!")
 
-    logger.info("Загружено %d записей. Запускаю бота…", len(rows))
+    logger.info("Загружено %d записей. Запускаю бота…", len(_snapshot.rows))
 
     app = (
         ApplicationBuilder()
@@ -251,16 +275,21 @@ def main() -> None:
         .connect_timeout(30)
         .read_timeout(30)
         .write_timeout(30)
+        .rate_limiter(AIORateLimiter(overall_max_rate=28))
+        .concurrent_updates(32)
         .build()
     )
 
     app.add_handler(CommandHandler("start", cmd_start))
     app.add_handler(CommandHandler("help", cmd_help))
-    app.add_handler(CommandHandler("reload", cmd_reload))
+    app.add_handler(CommandHandler("reload", cmd_reload, block=False))
     app.add_handler(CommandHandler("upload", cmd_upload))
-    app.add_handler(MessageHandler(filters.VIDEO | filters.Document.VIDEO | filters.PHOTO, handle_upload))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    app.add_handler(MessageHandler(
+        filters.VIDEO | filters.Document.VIDEO | filters.PHOTO, handle_upload, block=False,
+    ))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message, block=False))
     app.add_error_handler(error_handler)
+    app.job_queue.run_repeating(job_refresh, interval=refresh_interval, first=refresh_interval)
 
     app.run_polling(drop_pending_updates=True)
 
@@ -12,11 +12,23 @@ Usage:
 import argparse
 import csv
 import difflib
+import hashlib
+import heapq
+import io
 import json
+import math
+import pickle
 import re
+import shutil
 import sys
+import tempfile
 import threading
+import unicodedata
+import urllib.error
 import urllib.request
+from collections import Counter, defaultdict
+from dataclasses import dataclass
+from functools import lru_cache
 from pathlib import Path
 
 
@@ -26,21 +38,74 @@ DEFAULT_SHEET_CSV_URL = (
 )
 LOCAL_CSV = Path(__file__).parent / "ТехПроблемы Орион.csv"
 CONFIG_PATH = Path(__file__).parent / "config.json"
+CACHE_DIR = Path(__file__).parent / ".cache"
+# Bump when PreparedRows or normalization changes, so old pickles are ignored
+PREPARED_CACHE_VERSION = 1
 DEFAULT_REFRESH_INTERVAL = 1800  # 30 minutes
 
+# Common separators and sentence punctuation between queries in one cell
+_QUERY_SPLIT_RE = re.compile(r"[|;/\n.!?]+")
 
+# ETag / Last-Modified of the last successful download, per URL
+_http_validators: dict[str, dict[str, str]] = {}
+
+
+class _PunctTable(dict):
+    """str.translate table: word chars and whitespace kept, the rest -> space.
+
+    Filled lazily per code point, so only characters actually seen are stored.
+    """
+
+    def __missing__(self, cp: int) -> int:
+        ch = chr(cp)
+        keep = ch.isalnum() or ch == "_" or ch.isspace()
+        self[cp] = cp if keep else 0x20
+        return self[cp]
+
+
+_PUNCT_TABLE = _PunctTable()
+
+
+def _normalize_impl(text: str) -> str:
+    # Sheets text may mix precomposed/decomposed letters (й vs и + U+0306),
+    # fullwidth digits etc. is_normalized() is a cheap quick check, so the
+    # full NFKC pass only runs for the rare strings that need it.
+    if not unicodedata.is_normalized("NFKC", text):
+        text = unicodedata.normalize("NFKC", text)
+    return " ".join(text.casefold().translate(_PUNCT_TABLE).split())
+
+
+@lru_cache(maxsize=8192)
 def normalize(text: str) -> str:
-    text = text.lower().strip()
-    text = re.sub(r"\s+", " ", text)
-    text = re.sub(r"[^\w\sа-яёa-z0-9]", " ", text, flags=re.IGNORECASE)
-    text = re.sub(r"\s+", " ", text).strip()
-    return text
+    # Cached for queries and object codes, which repeat. Bulk row fields
+    # go through _normalize_impl so they don't evict those entries.
+    return _normalize_impl(text)
 
 
 def similarity(a: str, b: str) -> float:
     return difflib.SequenceMatcher(None, a, b).ratio()
 
 
+def _length_bound(a: str, b: str) -> float:
+    """Upper bound of similarity(a, b) from lengths alone (real_quick_ratio)."""
+    total = len(a) + len(b)
+    return 2.0 * min(len(a), len(b)) / total if total else 1.0
+
+
+def _common_chars(query_counts, cand_counts: dict) -> int:
+    """Size of the character multiset intersection, as counted by quick_ratio()."""
+    common = 0
+    for ch, n in query_counts:
+        k = cand_counts.get(ch)
+        if k:
+            common += n if n < k else k
+    return common
+
+
+def _trigrams(text: str) -> set[str]:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
 def load_config() -> dict:
     if not CONFIG_PATH.exists():
         return {
@@ -79,43 +144,97 @@ def get_object_synonyms(config: dict) -> dict:
     return {}
 
 
-def download_csv(url: str, dest: Path) -> bool:
-    """Download CSV from public Google Sheets URL and save locally."""
+def download_csv(url: str, dest: Path) -> bool | None:
+    """Download CSV from public Google Sheets URL and save locally.
+
+    Returns True on success, None if the sheet has not changed since the
+    last download (HTTP 304, dest is left as is) and False on failure.
+    """
+    headers = {}
+    validators = _http_validators.get(url, {}) if dest.exists() else {}
+    if "etag" in validators:
+        headers["If-None-Match"] = validators["etag"]
+    if "last_modified" in validators:
+        headers["If-Modified-Since"] = validators["last_modified"]
+
+    # Stream into a side file so a failed download never clobbers the
+    # local copy we fall back to.
+    tmp = None
     try:
-        req = urllib.request.Request(url)
+        req = urllib.request.Request(url, headers=headers)
         with urllib.request.urlopen(req, timeout=15) as resp:
-            data = resp.read()
-        dest.write_bytes(data)
+            with tempfile.NamedTemporaryFile(
+                dir=dest.parent, prefix=dest.name, suffix=".part", delete=False
+            ) as f:
+                tmp = Path(f.name)
+                shutil.copyfileobj(resp, f, 64 * 1024)
+            tmp.replace(dest)
+            _http_validators[url] = {
+                key: value
+                for key, value in (
+                    ("etag", resp.headers.get("ETag")),
+                    ("last_modified", resp.headers.get("Last-Modified")),
+                )
+                if value
+            }
         return True
     except Exception as exc:
+        if isinstance(exc, urllib.error.HTTPError) and exc.code == 304:
+            return None
         print(f"[!] Не удалось скачать таблицу: {exc}", file=sys.stderr)
+        if tmp is not None:
+            tmp.unlink(missing_ok=True)
         return False
 
 
 def load_rows(csv_path: Path):
-    rows = []
+    """Read CSV rows as dicts keyed by stripped, lower-cased header names.
+
+    Same shape as csv.DictReader: short rows get None for missing fields,
+    extra values go to a list under the None key.
+    """
     with csv_path.open(encoding="utf-8") as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            if not row:
-                continue
-            rows.append(row)
+        return _read_rows(f)
+
+
+def _read_rows(f) -> list[dict]:
+    rows = []
+    reader = csv.reader(f)
+    header = next(reader, None)
+    if header is None:
+        return rows
+    # Resolve header names once; every row shares these key strings
+    keys = [sys.intern(k.strip().lower()) if k else k for k in header]
+    width = len(keys)
+    for values in reader:
+        if not values:
+            continue
+        row = dict(zip(keys, values))
+        if len(values) < width:
+            row.update(dict.fromkeys(keys[len(values):]))
+        elif len(values) > width:
+            row[None] = values[width:]
+        rows.append(row)
     return rows
 
 
-def fetch_rows(sheet_url: str) -> list[dict] | None:
-    """Download sheet from Google and return rows, or None on failure."""
+def fetch_rows(sheet_url: str) -> "PreparedRows | None":
+    """Download sheet from Google and return prepared rows.
+
+    Returns None on failure or when the sheet has not changed since the
+    previous download, so callers keep the rows they already have.
+    """
     ok = download_csv(sheet_url, LOCAL_CSV)
     if not ok:
         return None
     try:
-        return load_rows(LOCAL_CSV)
+        return load_prepared(LOCAL_CSV)
     except Exception as exc:
         print(f"[!] Ошибка чтения скачанного CSV: {exc}", file=sys.stderr)
         return None
 
 
-def load_rows_with_fallback(sheet_url: str) -> list[dict]:
+def load_rows_with_fallback(sheet_url: str) -> "PreparedRows":
     """Try Google Sheets first, fall back to local CSV."""
     rows = fetch_rows(sheet_url)
     if rows:
@@ -125,9 +244,9 @@ def load_rows_with_fallback(sheet_url: str) -> list[dict]:
     # Fallback to local file
     if LOCAL_CSV.exists():
         print("[i] Используем локальную копию.", file=sys.stderr)
-        return load_rows(LOCAL_CSV)
+        return load_prepared(LOCAL_CSV)
 
-    return []
+    return prepare_rows([])
 
 
 def start_background_refresh(
@@ -136,9 +255,13 @@ def start_background_refresh(
     sheet_url: str,
     refresh_interval: int,
 ):
-    """Periodically re-download the sheet and update shared rows."""
+    """Periodically re-download the sheet and update shared rows.
 
-    def _refresh():
+    Runs in a single daemon thread until shared["stop_event"] is set.
+    """
+    stop_event = shared.setdefault("stop_event", threading.Event())
+
+    def _refresh_once():
         new_rows = fetch_rows(sheet_url)
         if new_rows:
             with lock:
@@ -147,71 +270,214 @@ def start_background_refresh(
                 "\n[i] Данные обновлены из Google Sheets.",
                 file=sys.stderr,
             )
-        # schedule next
-        t = threading.Timer(refresh_interval, _refresh)
-        t.daemon = True
-        t.start()
 
-    t = threading.Timer(refresh_interval, _refresh)
-    t.daemon = True
+    def _loop():
+        while not stop_event.wait(refresh_interval):
+            _refresh_once()
+
+    t = threading.Thread(target=_loop, name="sheet-refresh", daemon=True)
     t.start()
+    return t
 
 
 def _get_field_case_insensitive(row, field_name: str) -> str:
-    for k, v in row.items():
-        if k and k.strip().lower() == field_name.strip().lower():
-            return v or ""
-    return ""
+    # load_rows() already lower-cases header names
+    return row.get(field_name.strip().lower()) or ""
 
 
 def _get_object_code(row) -> str:
     val = _get_field_case_insensitive(row, "Объект")
     if not val and "" in row:
         val = row.get("") or ""
-    return normalize(val)
+    return _normalize_impl(val)
 
 
 def _split_queries(text: str):
     if not text:
         return []
-    # Split by common separators and sentence punctuation
-    parts = re.split(r"[|;/\n]+|[.!?]+", text)
+    parts = _QUERY_SPLIT_RE.split(text)
     return [p.strip() for p in parts if p.strip()]
 
 
+@dataclass(frozen=True, eq=False)
+class PreparedRows:
+    """CSV rows with their search fields normalized once at load time.
+
+    Column-oriented: the i-th element of every tuple belongs to rows[i].
+    Hashed by identity, so each load is its own key in the search cache.
+    """
+
+    objects: tuple[str, ...]  # normalized object code
+    candidates: tuple[tuple[str, ...], ...]  # normalized problem + queries
+    char_counts: tuple[tuple[dict[str, int], ...], ...]  # per candidate
+    trigrams: dict[str, tuple[int, ...]]  # trigram -> ids of rows containing it
+    rows: tuple[dict, ...]  # raw rows, for display
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+
+def prepare_rows(rows) -> PreparedRows:
+    # Cached results for older rows can never hit again; drop them so they
+    # don't keep the previous table alive.
+    _search.cache_clear()
+    objects, candidates, char_counts = [], [], []
+    postings = defaultdict(list)
+    for row_id, row in enumerate(rows):
+        problem = _get_field_case_insensitive(row, "Проблема")
+        queries = _get_field_case_insensitive(row, "запросы")
+        cands = [problem] + _split_queries(queries)
+        cands = tuple(_normalize_impl(c) for c in cands if c)
+        # A handful of object codes repeat across every row
+        objects.append(sys.intern(_get_object_code(row)))
+        candidates.append(cands)
+        char_counts.append(tuple(dict(Counter(c)) for c in cands))
+        for tri in set().union(*map(_trigrams, cands)):
+            postings[tri].append(row_id)
+    return PreparedRows(
+        objects=tuple(objects),
+        candidates=tuple(candidates),
+        char_counts=tuple(char_counts),
+        trigrams={tri: tuple(ids) for tri, ids in postings.items()},
+        rows=tuple(rows),
+    )
+
+
+def load_prepared(csv_path: Path) -> PreparedRows:
+    """prepare_rows(load_rows(csv_path)), reusing a pickled copy on disk.
+
+    The pickle is keyed by a hash of the CSV bytes, so an unchanged sheet
+    skips parsing and normalization entirely (e.g. on every CLI start).
+    """
+    data = csv_path.read_bytes()
+    digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+    cache_path = CACHE_DIR / f"prepared-v{PREPARED_CACHE_VERSION}-{digest}.pkl"
+    try:
+        with cache_path.open("rb") as f:
+            prepared = PreparedRows(**pickle.load(f))
+        _search.cache_clear()
+        return prepared
+    except FileNotFoundError:
+        pass
+    except Exception as exc:
+        print(f"[!] Не удалось прочитать кэш: {exc}", file=sys.stderr)
+
+    # Parse the bytes we hashed, not the file again: a concurrent download
+    # may already have replaced it.
+    text = io.TextIOWrapper(io.BytesIO(data), encoding="utf-8")
+    prepared = prepare_rows(_read_rows(text))
+    tmp = None
+    try:
+        CACHE_DIR.mkdir(exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            dir=CACHE_DIR, suffix=".part", delete=False
+        ) as f:
+            tmp = Path(f.name)
+            # Plain fields, not the class: it is __main__.PreparedRows when
+            # run as a script and search_solution.PreparedRows from bot.py.
+            pickle.dump(vars(prepared), f, protocol=pickle.HIGHEST_PROTOCOL)
+        tmp.replace(cache_path)
+        for old in CACHE_DIR.glob("prepared-*.pkl"):
+            if old != cache_path:
+                old.unlink(missing_ok=True)
+    except Exception as exc:
+        print(f"[!] Не удалось сохранить кэш: {exc}", file=sys.stderr)
+        if tmp is not None:
+            tmp.unlink(missing_ok=True)
+    return prepared
+
+
 def find_best(problem_text: str, rows, top_n: int = 1):
     return find_best_with_object(problem_text, rows, top_n, None)
 
 
 def find_best_with_object(
     problem_text: str,
-    rows,
+    rows: PreparedRows,
     top_n: int = 1,
     object_code: str | None = None,
 ):
-    needle = normalize(problem_text)
+    """Return [(score, row)] for the best matches among prepare_rows() output."""
+    obj_norm = normalize(object_code) if object_code else None
+    return list(
+        _search(normalize(problem_text), rows, max(top_n, 1), obj_norm)
+    )
+
+
+@lru_cache(maxsize=256)
+def _search(
+    needle: str,
+    rows: PreparedRows,
+    top_n: int,
+    obj_norm: str | None,
+) -> tuple:
+    """find_best_with_object() body; obj_norm is None when not filtering."""
     scored = []
-    for row in rows:
-        if object_code:
-            row_obj = _get_object_code(row)
-            if row_obj != normalize(object_code):
+    top = []  # min-heap of the top_n best row scores seen so far
+    cutoff = 0.0
+    needle_counts = Counter(needle).items()
+
+    # Substring hits score at least 0.95. If there are enough of them to fill
+    # the top, nothing below 0.95 can get in, and a cheap `in` pass lets the
+    # bounds below discard nearly every other candidate up front.
+    floor = 0.0
+    if needle:
+        hits = 0
+        for row_obj, candidates in zip(rows.objects, rows.candidates):
+            if obj_norm is not None and row_obj != obj_norm:
                 continue
-        problem = _get_field_case_insensitive(row, "Проблема")
-        queries = _get_field_case_insensitive(row, "запросы")
-        candidates = [problem] + _split_queries(queries)
+            if any(needle in c for c in candidates):
+                hits += 1
+                if hits >= top_n:
+                    floor = 0.95
+                    break
+
+    # Score rows that share many trigrams with the needle first: they are
+    # the likely winners and lift the cutoff early, so the bounds prune more
+    # of the rest. Only the scan order changes; every row is still considered.
+    order = range(len(rows))
+    needle_tris = _trigrams(needle)
+    if needle_tris:
+        shared = Counter()
+        for tri in needle_tris:
+            shared.update(rows.trigrams.get(tri, ()))
+        min_shared = math.ceil(len(needle_tris) * 0.3)
+        likely = sorted(i for i, n in shared.items() if n >= min_shared)
+        if likely:
+            likely_ids = set(likely)
+            order = likely + [i for i in order if i not in likely_ids]
+
+    for i in order:
+        if obj_norm is not None and rows.objects[i] != obj_norm:
+            continue
         best_score = 0.0
-        for cand in candidates:
-            if not cand:
-                continue
-            cand_norm = normalize(cand)
-            score = similarity(needle, cand_norm)
-            if needle and needle in cand_norm:
-                score = max(score, 0.95)
+        for cand_norm, counts in zip(rows.candidates[i], rows.char_counts[i]):
+            score = 0.95 if needle and needle in cand_norm else 0.0
+            # ratio() is the expensive part. Skip it unless the cheap upper
+            # bounds say it could lift this row above its own best and reach
+            # the current top_n cutoff (reaching is enough: ties go to the
+            # lower row id, whatever order the rows are scanned in).
+            bar = max(best_score, score)
+            reach = max(cutoff, floor)
+            bound = _length_bound(needle, cand_norm)
+            if bound > bar and bound >= reach:
+                # quick_ratio() bound from the histograms built at load time
+                total = len(needle) + len(cand_norm)
+                if total:
+                    bound = 2.0 * _common_chars(needle_counts, counts) / total
+                if bound > bar and bound >= reach:
+                    score = max(score, similarity(needle, cand_norm))
             if score > best_score:
                 best_score = score
-        scored.append((best_score, row))
-    scored.sort(key=lambda x: x[0], reverse=True)
-    return scored[: max(top_n, 1)]
+        scored.append((best_score, i))
+        if len(top) < top_n:
+            heapq.heappush(top, best_score)
+        elif best_score > top[0]:
+            heapq.heapreplace(top, best_score)
+        if len(top) == top_n:
+            cutoff = top[0]
+    best = heapq.nlargest(top_n, scored, key=lambda x: (x[0], -x[1]))
+    return tuple((score, rows.rows[i]) for score, i in best)
 
 
 def format_answer(scored):
@@ -228,20 +494,28 @@ def format_answer(scored):
     return "\n".join(lines)
 
 
-def detect_object_code(query: str, object_synonyms: dict) -> str | None:
-    qn = normalize(query)
-    best_code = None
-    best_len = 0
+def prepare_object_synonyms(object_synonyms: dict) -> list[tuple[str, str]]:
+    """Flatten config synonyms into (code, normalized synonym) pairs once."""
+    prepared = []
     for code, synonyms in object_synonyms.items():
         if not isinstance(synonyms, list):
             continue
-        candidates = synonyms + [code]
-        for s in candidates:
+        for s in synonyms + [code]:
             sn = normalize(str(s))
-            if sn and sn in qn and len(sn) > best_len:
-                best_code = code
-                best_len = len(sn)
-    return best_code
+            if sn:
+                prepared.append((code, sn))
+    # Longest first (stable for equal lengths), so the first hit wins
+    prepared.sort(key=lambda pair: len(pair[1]), reverse=True)
+    return prepared
+
+
+def detect_object_code(query: str, object_synonyms) -> str | None:
+    """object_synonyms is the output of prepare_object_synonyms()."""
+    qn = normalize(query)
+    for code, sn in object_synonyms:
+        if sn in qn:
+            return code
+    return None
 
 
 def main():
@@ -258,7 +532,7 @@ def main():
     config = load_config()
     sheet_url = get_sheet_url(config)
     refresh_interval = get_refresh_interval(config)
-    object_synonyms = get_object_synonyms(config)
+    object_synonyms = prepare_object_synonyms(get_object_synonyms(config))
 
     rows = load_rows_with_fallback(sheet_url)
     if not rows:
@@ -272,7 +546,7 @@ def main():
         return
 
     # Interactive mode — start background refresh
-    shared = {"rows": rows}
+    shared = {"rows": rows, "stop_event": threading.Event()}
     lock = threading.Lock()
     start_background_refresh(shared, lock, sheet_url, refresh_interval)
 
@@ -291,6 +565,8 @@ def main():
         print(format_answer(scored))
         print()
 
+    shared["stop_event"].set()
+
 
 if __name__ == "__main__":
     main()